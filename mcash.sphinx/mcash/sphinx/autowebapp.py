@@ -3,6 +3,7 @@ import inspect
 from collections import OrderedDict
 
 from docutils import nodes
+from docutils.parsers.rst import directives
 from docutils.statemachine import ViewList
 from sphinx.util.compat import Directive
 from sphinx.util.nodes import nested_parse_with_titles
@@ -14,6 +15,26 @@ from webapp2_extras import routes as wa_routes
 
 def setup(app):
     app.add_directive('autowebapp', ApiEndpointDirective)
+    app.connect('builder-inited', reset_route_indexes)
+
+
+route_indexes = {}
+
+
+def reset_route_indexes(app):
+    route_indexes.clear()
+
+
+def get_route_index(routes_path):
+    """
+    Return the :class:`RouteIndex` for ``routes_path``, building it on first use.
+    The index is kept for the rest of the build and shared between directives.
+    """
+    try:
+        return route_indexes[routes_path]
+    except KeyError:
+        index = route_indexes[routes_path] = RouteIndex(flatten_routes(utils.import_obj(routes_path)))
+        return index
 
 
 def flatten_routes(routes):
@@ -43,6 +64,102 @@ def normalize_template(template):
     return re.sub('<(\w+):[^>]+>', r'<\1>', template)
 
 
+def split_path(path):
+    path = path.strip('/')
+    return path.split('/') if path else []
+
+
+class RouteEntry(object):
+    __slots__ = ('position', 'url', 'handler', 'methods')
+
+    def __init__(self, position, route):
+        self.position = position
+        self.url = normalize_template(route.template)
+        self.handler = get_route_handler(route)
+        self.methods = {}
+        for method_name in map(webapp2._normalize_handler_method, route.methods or []):
+            self.methods[method_name] = route.handler_method or method_name
+
+
+class RouteIndex(object):
+    """
+    Flattened routes with their handlers resolved, indexed by path segment and by
+    handler name so that a slice of the route table can be looked up without
+    walking all of it.
+    """
+
+    def __init__(self, routes):
+        self.entries = []
+        self.tree = {}
+        self.by_handler = {}
+        for position, route in enumerate(routes):
+            entry = RouteEntry(position, route)
+            self.entries.append(entry)
+            self.by_handler.setdefault(entry.handler.__name__, []).append(entry)
+            node = self.tree
+            for segment in split_path(entry.url):
+                node = node.setdefault(segment, {})
+            node.setdefault(None, []).append(entry)
+
+    def collect(self, node):
+        for segment, child in node.items():
+            if segment is None:
+                for entry in child:
+                    yield entry
+            else:
+                for entry in self.collect(child):
+                    yield entry
+
+    def find_prefix(self, prefix):
+        """
+        Yield entries whose normalized url starts with ``prefix``.
+        """
+        prefix = normalize_template(prefix)
+        segments = split_path(prefix)
+        partial = segments.pop() if segments and not prefix.endswith('/') else ''
+        node = self.tree
+        for segment in segments:
+            node = node.get(segment)
+            if node is None:
+                return
+        for segment, child in node.items():
+            if segment is None:
+                if not partial:
+                    for entry in child:
+                        if entry.url.startswith(prefix):
+                            yield entry
+            elif segment.startswith(partial):
+                for entry in self.collect(child):
+                    if entry.url.startswith(prefix):
+                        yield entry
+
+    def select(self, include_prefixes=None, include_handlers=None, exclude_prefixes=(), exclude_handlers=()):
+        """
+        Return the entries matching the given filters in route table order.
+        """
+        if include_prefixes is not None:
+            entries = {}
+            for prefix in include_prefixes:
+                for entry in self.find_prefix(prefix):
+                    entries[entry.position] = entry
+            entries = entries.values()
+            if include_handlers is not None:
+                entries = [e for e in entries if e.handler.__name__ in include_handlers]
+        elif include_handlers is not None:
+            entries = []
+            for name in include_handlers:
+                entries.extend(self.by_handler.get(name, ()))
+        else:
+            entries = self.entries
+        exclude_prefixes = [normalize_template(prefix) for prefix in exclude_prefixes]
+        return sorted(
+            (e for e in entries
+             if e.handler.__name__ not in exclude_handlers
+             and not any(e.url.startswith(prefix) for prefix in exclude_prefixes)),
+            key=lambda e: e.position
+        )
+
+
 def get_auth_level(f):
     try:
         level = f._auth_level
@@ -74,7 +191,11 @@ class ApiEndpointDirective(Directive):
     option_spec = {
         'allowed-methods': lambda s: set(map(webapp2._normalize_handler_method, s.strip().split())),
         'exclude-handlers': lambda s: set(s.strip().split()),
+        'include-handlers': lambda s: set(s.strip().split()),
+        'include-prefix': lambda s: s.strip().split(),
+        'exclude-prefix': lambda s: s.strip().split(),
         'show-not-implemented': bool,
+        'lazy-schemas': directives.flag,
     }
 
     def __init__(self, name, arguments, options, content, lineno,
@@ -83,11 +204,14 @@ class ApiEndpointDirective(Directive):
             name, arguments, options, content, lineno, content_offset, block_text, state, state_machine
         )
         self.allowed_methods = self.options['allowed-methods']
-        self.exclude_handlers = self.options['exclude-handlers']
+        self.exclude_handlers = self.options.get('exclude-handlers', set())
+        self.include_handlers = self.options.get('include-handlers')
+        self.include_prefixes = self.options.get('include-prefix')
+        self.exclude_prefixes = self.options.get('exclude-prefix', [])
         self.show_not_implemented = self.options.get('show-not-implemented', False)
+        self.lazy_schemas = 'lazy-schemas' in self.options
         (self.routes_path, ) = self.arguments
-        self.routes = tuple(flatten_routes(utils.import_obj(self.routes_path)))
-        #self.handlers = {get_route_handler(route): route for route in self.routes}
+        self.route_index = get_route_index(self.routes_path)
         self.handler_map = self.build_handler_map()
 
     def build_handler_map(self):
@@ -101,24 +225,25 @@ class ApiEndpointDirective(Directive):
         }
         """
         handlers = OrderedDict()
-        for route in self.routes:
-            handler = get_route_handler(route)
-            if handler.__name__ in self.exclude_handlers:
-                continue
+        entries = self.route_index.select(
+            include_prefixes=self.include_prefixes,
+            include_handlers=self.include_handlers,
+            exclude_prefixes=self.exclude_prefixes,
+            exclude_handlers=self.exclude_handlers,
+        )
+        for entry in entries:
+            handler = entry.handler
             if handler in handlers:
                 urls = handlers[handler]
             else:
                 urls = handlers[handler] = OrderedDict()
-            url = normalize_template(route.template)
-            if url in urls:
-                methods = urls[url]
+            if entry.url in urls:
+                methods = urls[entry.url]
             else:
-                methods = urls[url] = {}
+                methods = urls[entry.url] = {}
 
-            for method_name in self.allowed_methods.intersection(
-                    map(webapp2._normalize_handler_method, route.methods or [])
-            ):
-                methods[method_name] = route.handler_method or method_name
+            for method_name in self.allowed_methods.intersection(entry.methods):
+                methods[method_name] = entry.methods[method_name]
 
         return handlers
 
@@ -169,6 +294,8 @@ class ApiEndpointDirective(Directive):
         path = utils.get_import_path(form)
         yield ''
         yield '.. wtforms:: {path}'.format(path=path)
+        if self.lazy_schemas:
+            yield '    :fragment:'
         yield ''
 
     def process_schemas(self, handler_method):
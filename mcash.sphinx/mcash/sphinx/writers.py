@@ -1,3 +1,11 @@
+import os
+import time
+import codecs
+import pickle
+import hashlib
+
+from sphinx.builders.html import StandaloneHTMLBuilder
+from sphinx.util.osutil import ensuredir, movefile
 from sphinx.writers.html import HTMLTranslator
 from docutils import nodes
 
@@ -62,3 +70,191 @@ class McashHTMLTranslator(HTMLTranslator):
             attributes['class'] = ' '.join(classes)
         node['classes'] = filter(None, map(lambda c: replace_classes.get(c, c), node['classes']))
         return HTMLTranslator.starttag(self, node, tagname, suffix=suffix, empty=empty, **attributes)
+
+
+def file_digest(filename):
+    if not os.path.isfile(filename):
+        return None
+    f = open(filename, 'rb')
+    try:
+        return hashlib.md5(f.read()).hexdigest()
+    finally:
+        f.close()
+
+
+def snapshot_tree(root, previous=None, exclude=(), exclude_dirs=()):
+    """
+    Map the path of every file below ``root``, relative to it and with ``/`` separators,
+    to ``(mtime, size, digest)``. Digests from ``previous`` are reused for files whose
+    mtime and size did not change. Temporary ``.tmp`` files are skipped.
+    """
+    previous = previous or {}
+    exclude_dirs = set(os.path.abspath(d) for d in exclude_dirs)
+    snapshot = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if os.path.abspath(os.path.join(dirpath, d)) not in exclude_dirs]
+        for filename in filenames:
+            filename = os.path.join(dirpath, filename)
+            relname = os.path.relpath(filename, root).replace(os.path.sep, '/')
+            if relname in exclude or relname.endswith('.tmp'):
+                continue
+            st = os.stat(filename)
+            old = previous.get(relname)
+            if old is not None and old[:2] == (st.st_mtime, st.st_size):
+                snapshot[relname] = old
+            else:
+                snapshot[relname] = (st.st_mtime, st.st_size, file_digest(filename))
+    return snapshot
+
+
+class McashHTMLBuilder(StandaloneHTMLBuilder):
+    """
+    HTML builder using :class:`McashHTMLTranslator` which leaves pages untouched when
+    their content did not change. Every output file that was added, modified or deleted
+    since the last finished build is listed in a manifest for deploy tooling, one ``A``,
+    ``M`` or ``D`` status and a tab separated path per line.
+    """
+    name = 'mcash-html'
+
+    state_filename = 'mcash-html.pickle'
+
+    def init(self):
+        self.load_state()
+        StandaloneHTMLBuilder.init(self)
+
+    def load_state(self):
+        """
+        Load the output snapshot and page render times saved by the last build which
+        finished. The manifest is relative to that build.
+        """
+        self.output_snapshot = {}
+        self.render_times = {}
+        self.last_hashes = None
+        try:
+            f = open(os.path.join(self.doctreedir, self.state_filename), 'rb')
+            try:
+                state = pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            return
+        self.output_snapshot = state['snapshot']
+        self.render_times = state['render_times']
+        self.last_hashes = state['hashes']
+
+    def save_state(self, snapshot):
+        ensuredir(self.doctreedir)
+        f = open(os.path.join(self.doctreedir, self.state_filename), 'wb')
+        try:
+            pickle.dump({
+                'snapshot': snapshot,
+                'render_times': self.render_times,
+                'hashes': (getattr(self, 'config_hash', ''), getattr(self, 'tags_hash', '')),
+            }, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+    def snapshot_output(self):
+        exclude = (self.config.mcash_html_manifest, ) if self.config.mcash_html_manifest else ()
+        # Keep the build cache out of the manifest when doctreedir is inside outdir
+        return snapshot_tree(self.outdir, previous=self.output_snapshot, exclude=exclude,
+                             exclude_dirs=(self.doctreedir, ))
+
+    def get_outdated_docs(self):
+        """
+        Unchanged pages keep the mtime of their last change, so the output file mtime
+        cannot tell whether a page is outdated. Use the time it was last rendered instead.
+        """
+        outdated = list(StandaloneHTMLBuilder.get_outdated_docs(self))
+        if self.last_hashes != (self.config_hash, self.tags_hash):
+            return outdated
+        if self.templates:
+            template_mtime = self.templates.newest_template_mtime()
+        else:
+            template_mtime = 0
+        docnames = []
+        for docname in outdated:
+            render_time = self.render_times.get(docname)
+            if render_time is not None:
+                try:
+                    srcmtime = max(os.path.getmtime(self.env.doc2path(docname)), template_mtime)
+                except EnvironmentError:
+                    pass
+                else:
+                    if srcmtime <= render_time:
+                        continue
+            docnames.append(docname)
+        return docnames
+
+    def init_translator_class(self):
+        StandaloneHTMLBuilder.init_translator_class(self)
+        if not self.config.html_translator_class:
+            self.translator_class = McashHTMLTranslator
+
+    def commit_output(self, tmpfilename, filename):
+        """
+        Move ``tmpfilename`` to ``filename`` unless the latter already has the same content.
+        Returns whether ``filename`` was changed.
+        """
+        if file_digest(tmpfilename) == file_digest(filename):
+            os.remove(tmpfilename)
+            return False
+        movefile(tmpfilename, filename)
+        return True
+
+    def write_output(self, filename, content, encoding='utf-8'):
+        tmpfilename = filename + '.tmp'
+        ensuredir(os.path.dirname(filename))
+        f = codecs.open(tmpfilename, 'w', encoding)
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        return self.commit_output(tmpfilename, filename)
+
+    def handle_page(self, pagename, addctx, templatename='page.html', outfilename=None, event_arg=None):
+        render_time = time.time()
+        outfilename = outfilename or self.get_outfilename(pagename)
+        tmpfilename = outfilename + '.tmp'
+        if os.path.isfile(tmpfilename):
+            os.remove(tmpfilename)
+        StandaloneHTMLBuilder.handle_page(self, pagename, addctx, templatename, tmpfilename, event_arg)
+        if os.path.isfile(tmpfilename):
+            self.commit_output(tmpfilename, outfilename)
+            self.render_times[pagename] = render_time
+
+    def get_output_changes(self, new):
+        """
+        Compare the ``new`` snapshot of the output directory with the one saved by the
+        last finished build and return a sorted list of ``(status, path)`` tuples.
+        """
+        old = self.output_snapshot
+        changes = []
+        for relname, (mtime, size, digest) in new.items():
+            if relname not in old:
+                changes.append((relname, 'A'))
+            elif old[relname][2] != digest:
+                changes.append((relname, 'M'))
+        for relname in old:
+            if relname not in new:
+                changes.append((relname, 'D'))
+        return [(status, relname) for relname, status in sorted(changes)]
+
+    def finish(self):
+        StandaloneHTMLBuilder.finish(self)
+        snapshot = self.snapshot_output()
+        if self.config.mcash_html_manifest:
+            changes = self.get_output_changes(snapshot)
+            f = open(os.path.join(self.outdir, self.config.mcash_html_manifest), 'w')
+            try:
+                for status, relname in changes:
+                    f.write('%s\t%s\n' % (status, relname))
+            finally:
+                f.close()
+            self.info('%d changed output files listed in %s' % (len(changes), self.config.mcash_html_manifest))
+        self.save_state(snapshot)
+
+
+def setup(app):
+    app.add_builder(McashHTMLBuilder)
+    app.add_config_value('mcash_html_manifest', 'changed_files.txt', 'html')
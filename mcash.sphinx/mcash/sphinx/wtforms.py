@@ -1,12 +1,20 @@
 """
 This Sphinx extension displays WTForms with fields
 """
+import os
 import re
+import posixpath
+import codecs
 import itertools
 from collections import OrderedDict
 from docutils import nodes
+from docutils.parsers.rst import directives
+from docutils.utils import new_document
+from sphinx.builders.epub import EpubBuilder
+from sphinx.builders.html import StandaloneHTMLBuilder, SingleFileHTMLBuilder
 from sphinx.util.compat import Directive
 from sphinx.util.docstrings import prepare_docstring
+from sphinx.util.osutil import ensuredir, relative_uri
 from docutils.statemachine import ViewList
 
 from mcash.utils import import_obj
@@ -41,6 +49,10 @@ class api_doc_node(nodes.General, nodes.Element):
     pass
 
 
+class schema_fragment_node(nodes.General, nodes.Element):
+    pass
+
+
 def field_type_role(role, rawtext, text, lineno, inliner, options={}, content=[]):
     return [api_doc_node('', field_type_override_node(rawtext, text))], []
 
@@ -102,6 +114,10 @@ validator_processors = {
 }
 
 
+# Keys of the schema fragments built during the current build
+fresh_fragments = set()
+
+
 class WTFormsDirective(Directive):
     # This should be written as a walker that emits events which in turn
     # create corresponding docutils nodes, as the form tree and doc tree are
@@ -110,6 +126,7 @@ class WTFormsDirective(Directive):
     show_form_name = False
     option_spec = {
         'exclude-docstring': bool,
+        'fragment': directives.flag,
     }
 
     def __init__(self, name, arguments, options, content, lineno,
@@ -117,10 +134,40 @@ class WTFormsDirective(Directive):
         super(WTFormsDirective, self).__init__(name, arguments, options, content, lineno,
                                                content_offset, block_text, state, state_machine)
         self.exclude_docstring = self.options.get('exclude-docstring', False)
+        self.fragment = 'fragment' in self.options
 
     def run(self):
-        # This starts processing and delegates to specific and generic process methods for forms and fields
         obj_path = self.content[0]
+        if self.fragment:
+            return [self.make_fragment(obj_path)]
+        return [self.build_form(obj_path)]
+
+    def make_fragment(self, obj_path):
+        """
+        Build the form table once per build and register it as a schema fragment written
+        next to the output. Returns a placeholder which is rendered as an expandable summary.
+        """
+        env = self.state.document.settings.env
+        fragments = env.wtforms_schema_fragments = getattr(env, 'wtforms_schema_fragments', OrderedDict())
+        key = obj_path if not self.exclude_docstring else obj_path + '-nodoc'
+        fragment = fragments.get(key)
+        if fragment is None or key not in fresh_fragments:
+            formclass = import_obj(obj_path)
+            fragment = fragments[key] = {
+                'doc': [self.build_form(obj_path)],
+                'name': formclass.__name__,
+                'field_count': len(list(formclass())),
+                'uri': '_schemas/%s.html' % key,
+                'docnames': fragment['docnames'] if fragment is not None else set(),
+            }
+            fresh_fragments.add(key)
+        fragment['docnames'].add(env.docname)
+        node = schema_fragment_node()
+        node['fragment'] = key
+        return node
+
+    def build_form(self, obj_path):
+        # This starts processing and delegates to specific and generic process methods for forms and fields
         formclass = import_obj(obj_path)
 
         root = nodes.definition_list()
@@ -136,7 +183,7 @@ class WTFormsDirective(Directive):
         env = self.state.document.settings.env
         self.form_fields = env.wtforms_form_fields = getattr(env, 'wtforms_form_fields', OrderedDict())
         self.process_form(formclass, root)
-        return [root]
+        return root
 
     def process_validators(self, field):
         validators = []
@@ -272,9 +319,14 @@ class WTFormsDirective(Directive):
 
 class FormFieldsDirective(Directive):
     has_content = True
+    option_spec = {
+        'per-form': directives.flag,
+    }
 
     def run(self):
-        return [form_fields_node()]
+        node = form_fields_node()
+        node['per_form'] = 'per-form' in self.options
+        return [node]
 
 
 class ApiDocDirective(Directive):
@@ -292,22 +344,121 @@ def process_form_field_nodes(app, doctree):
     process_from_fields_dict(form_fields)
     document = doctree.traverse(nodes.document)[0]
     content = []
+    per_form_docs = env.wtforms_per_form_docs = getattr(env, 'wtforms_per_form_docs', {})
+    per_form_docs.pop(env.docname, None)
     ff_nodes = doctree.traverse(form_fields_node)
     if ff_nodes:
-        for form_path, form_info in form_fields.items():
-            if form_info['is_base']:
-                continue
-            sec = nodes.section(ids=[form_info['target_id']])
-            sec.document = document
-            sec.append(nodes.title('', form_info['name']))
-            sec.extend(form_info['doc'])
-            content.append(sec)
-            form_info['docname'] = env.docname
+        per_form = any(node['per_form'] for node in ff_nodes)
+        if per_form:
+            per_form = per_form_docs[env.docname] = writes_collected_pages(app.builder)
+        if per_form:
+            content = make_form_field_index(env.docname, form_fields)
+        else:
+            for form_path, form_info in form_fields.items():
+                if form_info['is_base']:
+                    continue
+                sec = nodes.section(ids=[form_info['target_id']])
+                sec.document = document
+                sec.append(nodes.title('', form_info['name']))
+                sec.extend(form_info['doc'])
+                content.append(sec)
+                form_info['docname'] = env.docname
+                form_info.pop('page', None)
+                form_info.pop('index_docname', None)
         for node in ff_nodes:
             node.replace_self(content)
         env.build_toc_from(env.docname, doctree)
 
 
+def writes_collected_pages(builder):
+    """
+    Whether ``builder`` writes the extra pages and files from ``html-collect-pages``.
+    """
+    return (isinstance(builder, StandaloneHTMLBuilder)
+            and not isinstance(builder, (SingleFileHTMLBuilder, EpubBuilder)))
+
+
+def get_outdated_form_field_docs(app, env, added, changed, removed):
+    """
+    Re-read ``form-fields`` pages using ``:per-form:`` when the builder no longer
+    matches the mode they were read in, as the environment is shared between builders.
+    """
+    pages = writes_collected_pages(app.builder)
+    return [
+        docname for docname, per_form in getattr(env, 'wtforms_per_form_docs', {}).items()
+        if per_form != pages and docname in env.found_docs
+    ]
+
+
+def make_form_field_index(docname, form_fields):
+    """
+    Assign every non-base form its own page below ``docname`` and return an index
+    linking to them. The pages themselves are written by :func:`collect_form_field_pages`.
+    """
+    items = []
+    seen = set()
+    for form_path, form_info in form_fields.items():
+        if form_info['is_base'] or form_info['target_id'] in seen:
+            continue
+        seen.add(form_info['target_id'])
+        form_info['docname'] = form_info['page'] = '%s/%s' % (docname, form_path)
+        form_info['index_docname'] = docname
+        ref = field_type_ref()
+        ref['field_path'] = form_path
+        ref['text'] = form_info['name']
+        items.append(nodes.list_item('', nodes.paragraph('', '', ref)))
+    return [nodes.bullet_list('', *items)]
+
+
+def resolve_detached(app, pagename, content):
+    """
+    Resolve nodes that are not part of any source document as if they were located
+    at ``pagename``. Returns a new document holding copies of the nodes.
+    """
+    env = app.builder.env
+    doctree = new_document('<%s>' % pagename)
+    doctree.settings.env = env
+    doctree.extend([n.deepcopy() for n in content])
+    env.resolve_references(doctree, pagename, app.builder)
+    return doctree
+
+
+def render_children(app, doctree):
+    return ''.join([app.builder.render_partial(node)['fragment'] for node in doctree.children[:]])
+
+
+def render_detached(app, pagename, content):
+    """
+    Resolve and render nodes that are not part of any source document as if they
+    were located at ``pagename``. Returns the HTML fragment.
+    """
+    return render_children(app, resolve_detached(app, pagename, content))
+
+
+def collect_form_field_pages(app):
+    env = app.builder.env
+    form_fields = getattr(env, 'wtforms_form_fields', {})
+    seen = set()
+    for form_path, form_info in form_fields.items():
+        pagename = form_info.get('page')
+        if pagename is None or pagename in seen:
+            continue
+        seen.add(pagename)
+        sec = nodes.section(ids=[form_info['target_id']])
+        sec.append(nodes.title('', form_info['name']))
+        sec.extend(form_info['doc'])
+        doctree = resolve_detached(app, pagename, [sec])
+        indexer = getattr(app.builder, 'indexer', None)
+        if indexer is not None:
+            indexer.feed(pagename, form_info['name'], doctree)
+        context = {
+            'title': form_info['name'],
+            'body': render_children(app, doctree),
+            'wtforms_index_docname': form_info.get('index_docname'),
+        }
+        yield pagename, context, 'page.html'
+
+
 def process_from_fields_dict(form_fields):
     for form_path, form_info in form_fields.items():
         override_nodes = nodes.Element('', *form_info['doc']).traverse(field_type_override_node)
@@ -335,6 +486,8 @@ def find_field_info(field_info_map, path):
 
 
 def process_form_field_references(app, doctree, fromdocname):
+    # Inlined schema tables contain field references, so they go first
+    process_schema_fragments(app, doctree, fromdocname)
     env = app.builder.env
     form_fields = getattr(env, 'wtforms_form_fields', {})
 
@@ -356,18 +509,106 @@ def process_form_field_references(app, doctree, fromdocname):
         node.parent.remove(node)
 
 
+def reset_schema_fragments(app):
+    fresh_fragments.clear()
+
+
+def purge_schema_fragments(app, env, docname):
+    fragments = getattr(env, 'wtforms_schema_fragments', {})
+    for key, fragment in fragments.items():
+        fragment['docnames'].discard(docname)
+        if not fragment['docnames']:
+            del fragments[key]
+
+
+def process_schema_fragments(app, doctree, fromdocname):
+    env = app.builder.env
+    fragments = getattr(env, 'wtforms_schema_fragments', {})
+    pages = writes_collected_pages(app.builder)
+
+    for node in doctree.traverse(schema_fragment_node):
+        fragment = fragments[node['fragment']]
+        if not pages:
+            # Fragment files are only written with the collected pages, inline the table everywhere else
+            node.replace_self([n.deepcopy() for n in fragment['doc']])
+            continue
+        node['name'] = fragment['name']
+        node['field_count'] = fragment['field_count']
+        node['refuri'] = relative_uri(app.builder.get_target_uri(fromdocname), fragment['uri'])
+
+
+def write_schema_fragments(app):
+    env = app.builder.env
+    fragments = getattr(env, 'wtforms_schema_fragments', {})
+    write_output = getattr(app.builder, 'write_output', None)
+    for key, fragment in fragments.items():
+        pagename = os.path.splitext(fragment['uri'])[0]
+        filename = os.path.join(app.builder.outdir, fragment['uri'])
+        content = render_detached(app, pagename, fragment['doc'])
+        if write_output is not None:
+            # Builders such as McashHTMLBuilder only write changed output
+            write_output(filename, content)
+            continue
+        ensuredir(os.path.dirname(filename))
+        f = codecs.open(filename, 'w', 'utf-8')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+    remove_stale_schema_fragments(app.builder.outdir, fragments)
+    return []
+
+
+def remove_stale_schema_fragments(outdir, fragments):
+    """
+    Remove fragment files left in ``_schemas/`` for fragments that have been purged.
+    """
+    schemas_dir = os.path.join(outdir, '_schemas')
+    if not os.path.isdir(schemas_dir):
+        return
+    uris = set(fragment['uri'] for fragment in fragments.values())
+    for filename in os.listdir(schemas_dir):
+        if filename.endswith('.html') and '_schemas/' + filename not in uris:
+            os.remove(os.path.join(schemas_dir, filename))
+
+
+def rebase_refuris(node, from_uri, to_uri):
+    """
+    Rewrite the relative ``refuri`` of references in ``node``, which were made relative
+    to ``from_uri``, to be relative to ``to_uri``.
+    """
+    for ref in node.traverse(nodes.reference):
+        refuri = ref.get('refuri')
+        if refuri is None or refuri.startswith('/') or re.match(r'^[a-z][a-z0-9+.-]*:', refuri):
+            continue
+        target, sep, anchor = refuri.partition('#')
+        if target:
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(from_uri), target))
+        else:
+            target = from_uri
+        ref['refuri'] = relative_uri(to_uri, target) + sep + anchor
+
+
 def process_html_context(app, pagename, templatename, context, doctree):
+    tocname = pagename
     if doctree is None:
-        return
+        # Per-form pages have no doctree, they get the navigation of their index page
+        tocname = context.get('wtforms_index_docname')
+        if tocname is None:
+            return
     env = app.builder.env
-    toc = env.get_toctree_for(pagename, app.builder, collapse=True, maxdepth=3)
+    toc = env.get_toctree_for(tocname, app.builder, collapse=True, maxdepth=3)
     toc = toc[0].deepcopy()
+    if tocname != pagename:
+        rebase_refuris(toc, app.builder.get_target_uri(tocname), app.builder.get_target_uri(pagename))
     uls = toc.traverse(nodes.bullet_list)
     top_ul = uls.pop(0)
     top_ul['classes'].extend(('nav', 'sidenav'))
     for node in uls:
         node['classes'].append('nav')
     context['sidebar_globaltoc'] = app.builder.render_partial(toc)['fragment']
+    if doctree is None:
+        return
 
     toc = env.get_toc_for(pagename, app.builder)
     if len(toc) == 1 and len(toc[0]) == 2:
@@ -390,14 +631,67 @@ def depart_api_doc(self, node):
     self.depart_paragraph(node)
 
 
+schema_fragment_script = '''<script type="text/javascript">
+document.addEventListener('toggle', function (event) {
+    var details = event.target;
+    if (!details.open || !/\\bmcash-schema\\b/.test(details.className) || details.getAttribute('data-loaded')) {
+        return;
+    }
+    details.setAttribute('data-loaded', '1');
+    var src = new URL(details.getAttribute('data-src'), window.location.href);
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', src.href);
+    xhr.onerror = function () {
+        details.removeAttribute('data-loaded');
+    };
+    xhr.onload = function () {
+        if (xhr.status !== 200) {
+            details.removeAttribute('data-loaded');
+            return;
+        }
+        var body = details.querySelector('.mcash-schema-body');
+        body.innerHTML = xhr.responseText;
+        var links = body.querySelectorAll('a[href]');
+        for (var i = 0; i < links.length; i++) {
+            // Links in the fragment are relative to the fragment, not to this page
+            links[i].href = new URL(links[i].getAttribute('href'), src).href;
+        }
+    };
+    xhr.send();
+}, true);
+</script>
+'''
+
+
+def visit_schema_fragment(self, node):
+    if not getattr(self, 'schema_fragment_script_added', False):
+        self.body.append(schema_fragment_script)
+        self.schema_fragment_script_added = True
+    self.body.append(self.starttag(node, 'details', CLASS='mcash-schema', **{'data-src': node['refuri']}))
+    self.body.append('<summary>%s (%d fields)</summary>' % (self.encode(node['name']), node['field_count']))
+    # Shown until the fragment is loaded, and for readers where it cannot be loaded
+    self.body.append('<div class="mcash-schema-body"><a href="%s">Show schema</a></div>' % (
+        self.attval(node['refuri'])))
+
+
+def depart_schema_fragment(self, node):
+    self.body.append('</details>\n')
+
+
 def setup(app):
     app.add_directive('wtforms', WTFormsDirective)
     app.add_directive('form-fields', FormFieldsDirective)
     app.add_directive('api-documentation', ApiDocDirective)
+    app.connect('builder-inited', reset_schema_fragments)
+    app.connect('env-purge-doc', purge_schema_fragments)
+    app.connect('env-get-outdated', get_outdated_form_field_docs)
     app.connect('doctree-read', process_form_field_nodes)
     app.connect('doctree-resolved', process_form_field_references)
     app.connect('html-page-context', process_html_context)
+    app.connect('html-collect-pages', collect_form_field_pages)
+    app.connect('html-collect-pages', write_schema_fragments)
     app.add_role('field-type', field_type_role)
     app.add_role('wtforms', wtforms_role)
 
     app.add_node(api_doc_node, html=(visit_api_doc, depart_api_doc))
+    app.add_node(schema_fragment_node, html=(visit_schema_fragment, depart_schema_fragment))